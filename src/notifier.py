@@ -1,11 +1,27 @@
+import functools
+import heapq
 import json
+import logging
 import os
+import sys
 from datetime import datetime, timedelta, timezone
-from typing import Dict, Iterable, List, Optional
+from typing import TYPE_CHECKING, AbstractSet, Any, Dict, Iterable, Iterator, List, Optional, Tuple, Union
 from zoneinfo import ZoneInfo
 
-import requests
-from icalendar import Calendar, Event
+try:
+    import orjson
+except ImportError:  # optional, falls back to the stdlib json module
+    orjson = None
+
+if TYPE_CHECKING:
+    import requests
+    from icalendar import Calendar, Event
+
+logger = logging.getLogger("notifier")
+
+_UTC = timezone.utc
+_UTC_ZONE = ZoneInfo("UTC")
+STATE_RETENTION = timedelta(days=7)
 
 
 class ConfigurationError(Exception):
@@ -19,29 +35,70 @@ def load_env_variable(name: str, required: bool = True) -> Optional[str]:
     return value
 
 
-def ensure_timezone(name: Optional[str]) -> ZoneInfo:
-    if not name:
-        return ZoneInfo("UTC")
+@functools.lru_cache(maxsize=8)
+def _zone(name: str) -> ZoneInfo:
     try:
         return ZoneInfo(name)
     except Exception as exc:  # ZoneInfo raises multiple exception types
         raise ConfigurationError(f"Invalid TIMEZONE value: {name}") from exc
 
 
-def load_state(path: str) -> Dict[str, str]:
+def ensure_timezone(name: Optional[str]) -> ZoneInfo:
+    return _zone(name or "UTC")
+
+
+def load_state(path: str) -> Dict[str, Any]:
     if not os.path.exists(path):
         return {}
+    with open(path, "rb") as f:
+        data = f.read()
+    if not data:
+        return {}
     try:
-        with open(path, "r", encoding="utf-8") as f:
-            return json.load(f)
+        # orjson.JSONDecodeError subclasses json.JSONDecodeError.
+        return orjson.loads(data) if orjson is not None else json.loads(data)
     except json.JSONDecodeError:
         return {}
 
 
-def save_state(path: str, state: Dict[str, str]) -> None:
-    os.makedirs(os.path.dirname(path), exist_ok=True)
-    with open(path, "w", encoding="utf-8") as f:
-        json.dump(state, f, ensure_ascii=False, indent=2)
+def _write_atomic(path: str, data: bytes) -> None:
+    directory = os.path.dirname(path)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    # Write to a sibling file and rename so a crash never leaves a truncated file.
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "wb") as f:
+        f.write(data)
+    os.replace(tmp_path, path)
+
+
+def save_state(path: str, state: Dict[str, int]) -> None:
+    if orjson is not None:
+        data = orjson.dumps(state, option=orjson.OPT_INDENT_2)
+    else:
+        data = json.dumps(state, ensure_ascii=False, indent=2).encode("utf-8")
+    _write_atomic(path, data)
+
+
+def cleanup_old_state(state: Dict[str, Union[int, str]], cutoff: datetime) -> Dict[str, int]:
+    """Drop entries for events that started before ``cutoff``.
+
+    Entries are stored as epoch seconds; ISO strings written by older versions
+    are converted on the way through and any other value is dropped.
+    """
+    cutoff_ts = int(cutoff.timestamp())
+    cleaned: Dict[str, int] = {}
+    for uid, ts in state.items():
+        if isinstance(ts, bool) or not isinstance(ts, (int, str)):
+            continue
+        if isinstance(ts, str):
+            try:
+                ts = int(datetime.fromisoformat(ts).timestamp())
+            except ValueError:
+                continue
+        if ts >= cutoff_ts:
+            cleaned[uid] = ts
+    return cleaned
 
 
 def normalize_datetime(value) -> datetime:
@@ -50,53 +107,59 @@ def normalize_datetime(value) -> datetime:
         dt = value
     else:
         dt = datetime.combine(value, datetime.min.time())
-    if dt.tzinfo is None:
-        dt = dt.replace(tzinfo=timezone.utc)
-    return dt.astimezone(timezone.utc)
+    tzinfo = dt.tzinfo
+    if tzinfo is _UTC:
+        return dt
+    # icalendar returns ZoneInfo("UTC") for "...Z" values; it needs no conversion either.
+    if tzinfo is None or tzinfo is _UTC_ZONE:
+        return dt.replace(tzinfo=_UTC)
+    return dt.astimezone(_UTC)
+
+
+def _build_event(component: "Event", start: datetime) -> Dict:
+    get = component.get
+    decoded = component.decoded
+    uid_raw = get("UID")
+    summary_raw = get("SUMMARY")
+    description_raw = get("DESCRIPTION")
+    location_raw = get("LOCATION")
+    dtend = decoded("DTEND", None)
+
+    if dtend:
+        end = normalize_datetime(dtend)
+    else:
+        duration = decoded("DURATION", None)
+        end = start + duration if duration else start
 
+    return {
+        "uid": str(uid_raw) if uid_raw else "",
+        "summary": str(summary_raw) if summary_raw else "(無題)",
+        "start": start,
+        "end": end,
+        "description": str(description_raw) if description_raw else "",
+        "location": str(location_raw) if location_raw else "",
+    }
 
-def extract_events(calendar: Calendar) -> Iterable[Dict]:
-    for component in calendar.walk("VEVENT"):
-        if not isinstance(component, Event):
-            continue
-        uid = str(component.get("UID") or "")
-        summary = str(component.get("SUMMARY") or "(無題)")
-        dtstart = component.decoded("DTSTART")
-        dtend = component.decoded("DTEND", None)
-        duration = component.decoded("DURATION", None)
-
-        start = normalize_datetime(dtstart)
-        if dtend:
-            end = normalize_datetime(dtend)
-        elif duration:
-            end = start + duration
-        else:
-            end = start
 
-        description = str(component.get("DESCRIPTION") or "")
-        location = str(component.get("LOCATION") or "")
-        yield {
-            "uid": uid,
-            "summary": summary,
-            "start": start,
-            "end": end,
-            "description": description,
-            "location": location,
-        }
+def _format_timestamp(dt: datetime) -> str:
+    # Equivalent to f"{dt:%Y-%m-%d %H:%M}" without going through strftime.
+    return f"{dt.year:04d}-{dt.month:02d}-{dt.day:02d} {dt.hour:02d}:{dt.minute:02d}"
 
 
-def format_event(event: Dict, tz: ZoneInfo) -> str:
+def format_event(event: Dict, tz: ZoneInfo, tz_key: Optional[str] = None) -> str:
+    tz_key = tz_key or tz.key
     start_local = event["start"].astimezone(tz)
     end_local = event["end"].astimezone(tz)
-    start_utc = event["start"].astimezone(timezone.utc)
-    end_utc = event["end"].astimezone(timezone.utc)
+    # iter_upcoming already yields UTC datetimes.
+    start_utc = event["start"]
+    end_utc = event["end"]
 
     details: List[str] = [f"**{event['summary']}**"]
     details.append(
-        f"開始: {start_local:%Y-%m-%d %H:%M} ({tz.key}) / {start_utc:%Y-%m-%d %H:%M} (UTC)"
+        f"開始: {_format_timestamp(start_local)} ({tz_key}) / {_format_timestamp(start_utc)} (UTC)"
     )
     details.append(
-        f"終了: {end_local:%Y-%m-%d %H:%M} ({tz.key}) / {end_utc:%Y-%m-%d %H:%M} (UTC)"
+        f"終了: {_format_timestamp(end_local)} ({tz_key}) / {_format_timestamp(end_utc)} (UTC)"
     )
     if event["location"]:
         details.append(f"場所: {event['location']}")
@@ -107,42 +170,130 @@ def format_event(event: Dict, tz: ZoneInfo) -> str:
 
 def build_message(events: List[Dict], tz: ZoneInfo, window_minutes: int) -> str:
     header = f"以下の予定が{window_minutes}分以内に開始します:\n"
-    body = "\n\n".join(format_event(event, tz) for event in events)
+    tz_key = tz.key
+    body = "\n\n".join(format_event(event, tz, tz_key) for event in events)
     return header + body
 
 
-def fetch_calendar(url: str) -> Calendar:
-    response = requests.get(url, timeout=15)
+@functools.lru_cache(maxsize=None)
+def _session() -> "requests.Session":
+    """Return the keep-alive session shared by the iCal fetch and the webhook POST."""
+    import requests
+    from requests.adapters import HTTPAdapter
+    from urllib3.util.retry import Retry
+
+    # Status and read retries only apply to idempotent methods, so the webhook
+    # POST is retried on connection failures alone and cannot be delivered twice.
+    # Retry-After is ignored so a throttling server cannot stall a cron run for hours.
+    retry = Retry(
+        total=3,
+        backoff_factor=0.5,
+        status_forcelist=(500, 502, 503, 504),
+        respect_retry_after_header=False,
+    )
+    session = requests.Session()
+    session.mount("https://", HTTPAdapter(pool_connections=4, pool_maxsize=4, max_retries=retry))
+    return session
+
+
+def _http_cache_path(cache_path: str) -> str:
+    return f"{cache_path}.http.json"
+
+
+def load_http_cache(cache_path: str) -> Dict[str, str]:
+    """Load the ETag/Last-Modified validators stored next to the cached calendar."""
+    if not os.path.exists(cache_path):
+        return {}
+    data = load_state(_http_cache_path(cache_path))
+    if not isinstance(data, dict):
+        return {}
+    return {
+        key: value
+        for key, value in data.items()
+        if key in ("etag", "last_modified") and isinstance(value, str)
+    }
+
+
+def save_calendar_cache(cache_path: str, body: bytes, http_cache: Dict[str, str]) -> None:
+    # The body goes first: stale validators next to a newer body only cost a full GET.
+    _write_atomic(cache_path, body)
+    _write_atomic(_http_cache_path(cache_path), json.dumps(http_cache).encode("utf-8"))
+
+
+def fetch_calendar(
+    url: str,
+    http_cache: Optional[Dict[str, str]] = None,
+    cache_path: Optional[str] = None,
+) -> Tuple["Calendar", Optional[bytes]]:
+    """Fetch and parse the calendar, using a conditional GET when a cached copy exists.
+
+    ``http_cache`` holds the validators of the body stored at ``cache_path`` and is
+    updated in place from the response. Returns the calendar and the body to store
+    with ``save_calendar_cache``, or ``None`` when there is nothing new to cache.
+    """
+    from icalendar import Calendar
+
+    headers: Dict[str, str] = {}
+    use_cache = bool(http_cache) and cache_path is not None and os.path.exists(cache_path)
+    if use_cache:
+        if http_cache.get("etag"):
+            headers["If-None-Match"] = http_cache["etag"]
+        if http_cache.get("last_modified"):
+            headers["If-Modified-Since"] = http_cache["last_modified"]
+
+    response = _session().get(url, headers=headers, timeout=15)
+    if use_cache and response.status_code == 304:
+        with open(cache_path, "rb") as f:
+            return Calendar.from_ical(f.read()), None
     response.raise_for_status()
-    return Calendar.from_ical(response.content)
+    calendar = Calendar.from_ical(response.content)
+
+    if http_cache is None or cache_path is None:
+        return calendar, None
+    http_cache.clear()
+    etag = response.headers.get("ETag")
+    last_modified = response.headers.get("Last-Modified")
+    if etag:
+        http_cache["etag"] = etag
+    if last_modified:
+        http_cache["last_modified"] = last_modified
+    return calendar, response.content if http_cache else None
+
 
+def _event_start(event: Dict) -> datetime:
+    return event["start"]
 
-def detect_upcoming_events(
-    events: Iterable[Dict],
+
+def iter_upcoming(
+    components: Iterable["Event"],
     window_minutes: int,
     now: datetime,
-    notified_ids: Dict[str, str],
-) -> List[Dict]:
+    notified_ids: AbstractSet[str],
+) -> Iterator[Dict]:
+    """Yield events from VEVENT components that start within the window.
+
+    UID and DTSTART are checked first so the remaining properties are only
+    decoded for events that will be notified.
+    """
+    from icalendar import Event
+
     window_end = now + timedelta(minutes=window_minutes)
-    filtered = []
-    for event in events:
-        if not event["uid"]:
-            continue
-        if event["uid"] in notified_ids:
-            continue
-        if event["start"] < now:
+    for component in components:
+        if not isinstance(component, Event):
             continue
-        if event["start"] > window_end:
+        uid_raw = component.get("UID")
+        if not uid_raw or str(uid_raw) in notified_ids:
             continue
-        if event["end"] <= now:
+        start = normalize_datetime(component.decoded("DTSTART"))
+        if start < now or start > window_end:
             continue
-        filtered.append(event)
-    filtered.sort(key=lambda e: e["start"])
-    return filtered
+        event = _build_event(component, start)
+        if event["end"] > now:
+            yield event
 
 
 def notify_webhook(url: str, message: str) -> None:
-    response = requests.post(url, json={"text": message}, timeout=10)
+    response = _session().post(url, json={"text": message}, timeout=10)
     response.raise_for_status()
 
 
@@ -154,8 +305,9 @@ def main() -> int:
         timezone_name = load_env_variable("TIMEZONE", required=False)
         max_events_raw = load_env_variable("MAX_EVENTS", required=False)
         state_file = load_env_variable("STATE_FILE", required=False) or "state/notifications.json"
+        calendar_cache = load_env_variable("CALENDAR_CACHE_FILE", required=False)
     except ConfigurationError as exc:
-        print(f"[ERROR] {exc}")
+        logger.error("%s", exc)
         return 1
 
     try:
@@ -163,7 +315,7 @@ def main() -> int:
         if window_minutes <= 0:
             raise ValueError
     except ValueError:
-        print("[ERROR] NOTICE_WINDOW_MINUTES must be a positive integer")
+        logger.error("NOTICE_WINDOW_MINUTES must be a positive integer")
         return 1
 
     max_events = None
@@ -173,47 +325,81 @@ def main() -> int:
             if parsed > 0:
                 max_events = parsed
         except ValueError:
-            print("[WARN] Ignoring MAX_EVENTS because it is not a number")
+            logger.warning("Ignoring MAX_EVENTS because it is not a number")
 
     tz = ensure_timezone(timezone_name)
-    print(f"[INFO] Using timezone: {tz.key}")
+    logger.info("Using timezone: %s", tz.key)
+
+    stored_state = load_state(state_file)
+    http_cache = load_http_cache(calendar_cache) if calendar_cache else None
 
     try:
-        calendar = fetch_calendar(ical_url)
+        calendar, new_body = fetch_calendar(ical_url, http_cache, calendar_cache)
     except Exception as exc:  # network or parsing errors
-        print(f"[ERROR] Failed to fetch or parse calendar: {exc}")
+        logger.error("Failed to fetch or parse calendar: %s", exc)
         return 1
 
-    events = list(extract_events(calendar))
-    print(f"[INFO] Retrieved {len(events)} events from calendar")
+    components = calendar.walk("VEVENT")
+    logger.info("Retrieved %d events from calendar", len(components))
 
     now = datetime.now(timezone.utc)
-    notified_state = load_state(state_file)
-    upcoming = detect_upcoming_events(events, window_minutes, now, notified_state)
+    notified_state = cleanup_old_state(stored_state, now - STATE_RETENTION)
+    removed = len(stored_state) - len(notified_state)
+    if removed:
+        logger.info("Removed %d expired entries from notification state", removed)
+    # Also catches legacy ISO entries rewritten as epoch seconds by the cleanup.
+    dirty = notified_state != stored_state
+    candidates = iter_upcoming(components, window_minutes, now, frozenset(notified_state))
     if max_events:
-        upcoming = upcoming[:max_events]
+        upcoming = heapq.nsmallest(max_events, candidates, key=_event_start)
+    else:
+        upcoming = sorted(candidates, key=_event_start)
 
     if not upcoming:
-        print("[INFO] No upcoming events to notify")
-        save_state(state_file, notified_state)
-        print(f"[INFO] Ensured notification state is stored at {state_file}")
+        logger.info("No upcoming events to notify")
+        if dirty:
+            save_state(state_file, notified_state)
+            logger.info("Saved notification state to %s", state_file)
+        else:
+            logger.info("State unchanged; skipped writing %s", state_file)
+        if new_body is not None:
+            save_calendar_cache(calendar_cache, new_body, http_cache)
         return 0
 
     message = build_message(upcoming, tz, window_minutes)
-    print(f"[INFO] Sending notification for {len(upcoming)} event(s)")
+    logger.info("Sending notification for %d event(s)", len(upcoming))
 
     try:
         notify_webhook(webhook_url, message)
     except Exception as exc:
-        print(f"[ERROR] Failed to send notification: {exc}")
+        logger.error("Failed to send notification: %s", exc)
         return 1
 
     for event in upcoming:
-        notified_state[event["uid"]] = event["start"].isoformat()
+        notified_state[event["uid"]] = int(event["start"].timestamp())
     save_state(state_file, notified_state)
-    print(f"[INFO] Saved notification state to {state_file}")
+    logger.info("Saved notification state to %s", state_file)
+    # Only cache the new body once the notifications it produced are recorded.
+    if new_body is not None:
+        save_calendar_cache(calendar_cache, new_body, http_cache)
     return 0
 
 
+def _configure_logging() -> None:
+    level_name = (os.getenv("LOG_LEVEL") or "INFO").upper()
+    # getLevelName returns "Level <name>" for names it does not know.
+    level = logging.getLevelName(level_name)
+    valid = isinstance(level, int)
+    # stdout, like the print() calls this replaced, so CI log scraping keeps working.
+    logging.basicConfig(
+        level=level if valid else logging.INFO,
+        format="[%(levelname)s] %(message)s",
+        stream=sys.stdout,
+    )
+    if not valid:
+        logger.warning("Ignoring LOG_LEVEL because %s is not a valid level", level_name)
+
+
 if __name__ == "__main__":
+    _configure_logging()
     raise SystemExit(main())
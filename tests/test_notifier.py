@@ -1,9 +1,10 @@
+import json
 import sys
 from datetime import datetime, timedelta, timezone
 from pathlib import Path
 
 import pytest
-from icalendar import Calendar
+from icalendar import Calendar, Event
 
 sys.path.append(str(Path(__file__).resolve().parents[1]))
 
@@ -11,8 +12,14 @@ from src import notifier
 
 
 class DummyResponse:
-    def __init__(self, content: bytes):
+    def __init__(self, content: bytes, status_code: int = 200, headers=None):
         self.content = content
+        self.status_code = status_code
+        self.headers = headers or {}
+
+    @property
+    def text(self) -> str:
+        raise AssertionError("fetch_calendar should parse the raw bytes, not decoded text")
 
     def raise_for_status(self) -> None:  # pragma: no cover - placeholder for parity with requests.Response
         return None
@@ -23,7 +30,7 @@ def test_fetch_calendar_uses_binary(monkeypatch):
     calendar.add("PRODID", "-//Example Corp//CalDAV Client//EN")
     calendar.add("VERSION", "2.0")
 
-    event = notifier.Event()
+    event = Event()
     event.add("UID", "1234")
     event.add("SUMMARY", "Test event")
     event.add("DTSTART", datetime(2024, 1, 1, tzinfo=timezone.utc))
@@ -31,30 +38,142 @@ def test_fetch_calendar_uses_binary(monkeypatch):
 
     ical_bytes = calendar.to_ical()
 
-    def fake_get(url: str, timeout: int) -> DummyResponse:  # type: ignore[unused-arg]
+    def fake_get(url: str, headers, timeout: int) -> DummyResponse:  # type: ignore[unused-arg]
         return DummyResponse(ical_bytes)
 
-    monkeypatch.setattr(notifier.requests, "get", fake_get)
+    monkeypatch.setattr(notifier._session(), "get", fake_get)
 
-    parsed = notifier.fetch_calendar("http://example.com/calendar.ics")
-    events = list(notifier.extract_events(parsed))
+    parsed, new_body = notifier.fetch_calendar("http://example.com/calendar.ics")
+    events = parsed.walk("VEVENT")
 
+    assert new_body is None
     assert len(events) == 1
-    assert events[0]["summary"] == "Test event"
+    assert events[0]["SUMMARY"] == "Test event"
+
+
+def test_fetch_calendar_reuses_cache_on_not_modified(monkeypatch, tmp_path):
+    calendar = Calendar()
+    event = Event()
+    event.add("UID", "1234")
+    event.add("SUMMARY", "Cached event")
+    event.add("DTSTART", datetime(2024, 1, 1, tzinfo=timezone.utc))
+    calendar.add_component(event)
+    cache_path = tmp_path / "calendar.ics"
+    sent_headers = []
+
+    def fake_get(url: str, headers, timeout: int) -> DummyResponse:  # type: ignore[unused-arg]
+        sent_headers.append(headers)
+        if headers.get("If-None-Match") == '"v1"':
+            return DummyResponse(b"", status_code=304)
+        return DummyResponse(calendar.to_ical(), headers={"ETag": '"v1"'})
+
+    monkeypatch.setattr(notifier._session(), "get", fake_get)
+
+    http_cache = notifier.load_http_cache(str(cache_path))
+    _, new_body = notifier.fetch_calendar("http://example.com/calendar.ics", http_cache, str(cache_path))
+    assert http_cache == {"etag": '"v1"'}
+    assert not cache_path.exists()
+    notifier.save_calendar_cache(str(cache_path), new_body, http_cache)
+
+    http_cache = notifier.load_http_cache(str(cache_path))
+    parsed, new_body = notifier.fetch_calendar("http://example.com/calendar.ics", http_cache, str(cache_path))
+    events = parsed.walk("VEVENT")
 
+    assert new_body is None
+    assert sent_headers == [{}, {"If-None-Match": '"v1"'}]
+    assert events[0]["SUMMARY"] == "Cached event"
 
-def test_detect_upcoming_events_filters_and_sorts():
+
+def test_session_retries_are_bounded_and_skip_post_status_errors():
+    retry = notifier._session().get_adapter("https://example.com").max_retries
+
+    assert retry.total == 3
+    assert retry.respect_retry_after_header is False
+    assert retry.is_retry("GET", 503, has_retry_after=True)
+    assert not retry.is_retry("GET", 429, has_retry_after=True)
+    assert not retry.is_retry("POST", 503, has_retry_after=True)
+
+
+def test_iter_upcoming_filters_window_and_notified():
     now = datetime(2024, 1, 1, 12, 0, tzinfo=timezone.utc)
-    events = [
-        {"uid": "1", "start": now + timedelta(minutes=10), "end": now + timedelta(minutes=20)},
-        {"uid": "2", "start": now - timedelta(minutes=5), "end": now + timedelta(minutes=5)},
-        {"uid": "3", "start": now + timedelta(minutes=30), "end": now + timedelta(minutes=40)},
-        {"uid": "4", "start": now + timedelta(minutes=15), "end": now + timedelta(minutes=25)},
-    ]
+    calendar = Calendar()
+    for uid, start, end in [
+        ("1", now + timedelta(minutes=10), now + timedelta(minutes=20)),
+        ("2", now - timedelta(minutes=5), now + timedelta(minutes=5)),
+        ("3", now + timedelta(minutes=30), now + timedelta(minutes=40)),
+        ("4", now + timedelta(minutes=15), now + timedelta(minutes=25)),
+        ("", now + timedelta(minutes=5), now + timedelta(minutes=10)),
+    ]:
+        event = Event()
+        if uid:
+            event.add("UID", uid)
+        event.add("DTSTART", start)
+        event.add("DTEND", end)
+        calendar.add_component(event)
 
-    upcoming = notifier.detect_upcoming_events(events, window_minutes=20, now=now, notified_ids={"1": ""})
+    upcoming = list(
+        notifier.iter_upcoming(calendar.walk("VEVENT"), window_minutes=20, now=now, notified_ids=frozenset({"1"}))
+    )
 
     assert [event["uid"] for event in upcoming] == ["4"]
+    assert upcoming[0]["summary"] == "(無題)"
+
+
+def test_normalize_datetime_returns_timezone_utc():
+    parsed = Calendar.from_ical(
+        b"BEGIN:VCALENDAR\r\nBEGIN:VEVENT\r\nUID:1\r\nDTSTART:20240101T090000Z\r\n"
+        b"END:VEVENT\r\nEND:VCALENDAR\r\n"
+    )
+    dtstart = parsed.walk("VEVENT")[0].decoded("DTSTART")
+    tokyo = datetime(2024, 1, 1, 18, 0, tzinfo=notifier.ZoneInfo("Asia/Tokyo"))
+
+    for value in (dtstart, tokyo, datetime(2024, 1, 1, 9, 0)):
+        normalized = notifier.normalize_datetime(value)
+        assert normalized.tzinfo is timezone.utc
+        assert normalized == datetime(2024, 1, 1, 9, 0, tzinfo=timezone.utc)
+
+
+def test_cleanup_old_state_drops_expired_and_migrates_iso():
+    cutoff = datetime(2024, 1, 1, tzinfo=timezone.utc)
+    state = {
+        "old": int((cutoff - timedelta(hours=1)).timestamp()),
+        "new": int((cutoff + timedelta(hours=1)).timestamp()),
+        "legacy": (cutoff + timedelta(hours=2)).isoformat(),
+        "legacy-old": (cutoff - timedelta(hours=2)).isoformat(),
+    }
+
+    cleaned = notifier.cleanup_old_state(state, cutoff)
+
+    assert cleaned == {
+        "new": int((cutoff + timedelta(hours=1)).timestamp()),
+        "legacy": int((cutoff + timedelta(hours=2)).timestamp()),
+    }
+
+
+def test_save_state_round_trip(tmp_path):
+    path = tmp_path / "state" / "notifications.json"
+    state = {"abc": 1704067200, "日本語": 1704070800}
+
+    notifier.save_state(str(path), state)
+
+    assert notifier.load_state(str(path)) == state
+    assert not (tmp_path / "state" / "notifications.json.tmp").exists()
+
+
+def test_load_state_recovers_from_empty_or_corrupt_file(tmp_path):
+    path = tmp_path / "notifications.json"
+    path.write_bytes(b"")
+    assert notifier.load_state(str(path)) == {}
+
+    path.write_bytes(b"{not json")
+    assert notifier.load_state(str(path)) == {}
+
+
+def test_ensure_timezone_rejects_unknown_zone():
+    assert notifier.ensure_timezone(None).key == "UTC"
+    assert notifier.ensure_timezone("Asia/Tokyo") is notifier.ensure_timezone("Asia/Tokyo")
+    with pytest.raises(notifier.ConfigurationError):
+        notifier.ensure_timezone("Not/AZone")
 
 
 def test_build_message_formats_timezone():
@@ -71,4 +190,158 @@ def test_build_message_formats_timezone():
     message = notifier.build_message([event], tz, window_minutes=60)
 
     assert "UTC" in message
+    assert "2024-01-01 09:00 (UTC) / 2024-01-01 09:00 (UTC)" in message
     assert "Planning meeting" in message
+
+
+def test_configure_logging_falls_back_on_invalid_level(monkeypatch, caplog):
+    monkeypatch.setenv("LOG_LEVEL", "verbose")
+    config = {}
+    monkeypatch.setattr(notifier.logging, "basicConfig", lambda **kwargs: config.update(kwargs))
+
+    notifier._configure_logging()
+
+    assert config["level"] == notifier.logging.INFO
+    assert config["stream"] is sys.stdout
+    assert notifier.logger.name == "notifier"
+    assert "Ignoring LOG_LEVEL because VERBOSE is not a valid level" in caplog.text
+
+
+def _run_main(monkeypatch, tmp_path, state, events=(), etag='"v1"', post=None):
+    """Run main() once against a fake session, a state file and a cached calendar."""
+    calendar = Calendar()
+    for uid, start in [("later", datetime.now(timezone.utc) + timedelta(days=2)), *events]:
+        event = Event()
+        event.add("UID", uid)
+        event.add("SUMMARY", uid)
+        event.add("DTSTART", start)
+        calendar.add_component(event)
+    cache_path = tmp_path / "calendar.ics"
+    if not cache_path.exists():
+        notifier.save_calendar_cache(str(cache_path), calendar.to_ical(), {"etag": '"v1"'})
+    state_path = tmp_path / "notifications.json"
+    if state is not None:
+        state_path.write_text(json.dumps(state), encoding="utf-8")
+
+    def fake_get(url: str, headers, timeout: int) -> DummyResponse:  # type: ignore[unused-arg]
+        if headers.get("If-None-Match") == etag:
+            return DummyResponse(b"", status_code=304)
+        return DummyResponse(calendar.to_ical(), headers={"ETag": etag})
+
+    posted = []
+
+    def fake_post(url: str, json, timeout: int) -> DummyResponse:  # type: ignore[unused-arg]
+        posted.append(json["text"])
+        return DummyResponse(b"")
+
+    saved = []
+    original_save_state = notifier.save_state
+
+    def spy_save_state(*args) -> None:
+        saved.append(args)
+        original_save_state(*args)
+
+    monkeypatch.setattr(notifier._session(), "get", fake_get)
+    monkeypatch.setattr(notifier._session(), "post", post or fake_post)
+    monkeypatch.setattr(notifier, "save_state", spy_save_state)
+    monkeypatch.setenv("ICAL_URL", "https://example.com/calendar.ics")
+    monkeypatch.setenv("MATTERMOST_WEBHOOK_URL", "https://example.com/hooks/abc")
+    monkeypatch.setenv("NOTICE_WINDOW_MINUTES", "30")
+    monkeypatch.setenv("STATE_FILE", str(state_path))
+    monkeypatch.setenv("CALENDAR_CACHE_FILE", str(cache_path))
+
+    code = notifier.main()
+    return code, saved, posted, notifier.load_state(str(state_path))
+
+
+def test_main_skips_save_when_state_unchanged(monkeypatch, tmp_path):
+    start_ts = int((datetime.now(timezone.utc) - timedelta(hours=1)).timestamp())
+    state = {"done": start_ts}
+
+    code, saved, _, stored = _run_main(monkeypatch, tmp_path, state)
+
+    assert code == 0
+    assert saved == []
+    assert stored == state
+
+
+def test_main_saves_migrated_legacy_entries(monkeypatch, tmp_path):
+    start = datetime.now(timezone.utc).replace(microsecond=0) - timedelta(hours=1)
+    state = {"done": start.isoformat()}
+
+    code, saved, _, stored = _run_main(monkeypatch, tmp_path, state)
+
+    assert code == 0
+    assert len(saved) == 1
+    assert stored == {"done": int(start.timestamp())}
+
+
+def test_main_saves_pruned_entries(monkeypatch, tmp_path):
+    expired_ts = int((datetime.now(timezone.utc) - timedelta(days=30)).timestamp())
+    state = {"expired": expired_ts, "_http": {"etag": '"v0"'}}
+
+    code, saved, _, stored = _run_main(monkeypatch, tmp_path, state)
+
+    assert code == 0
+    assert len(saved) == 1
+    assert stored == {}
+
+
+def test_main_caches_new_etag_outside_state(monkeypatch, tmp_path):
+    start_ts = int((datetime.now(timezone.utc) - timedelta(hours=1)).timestamp())
+    state = {"done": start_ts}
+
+    code, saved, _, stored = _run_main(monkeypatch, tmp_path, state, etag='"v2"')
+
+    assert code == 0
+    assert saved == []
+    assert stored == state
+    assert notifier.load_http_cache(str(tmp_path / "calendar.ics")) == {"etag": '"v2"'}
+
+
+def test_main_handles_event_uid_colliding_with_old_cache_key(monkeypatch, tmp_path):
+    soon = datetime.now(timezone.utc) + timedelta(minutes=5)
+
+    messages = []
+    for _ in range(3):
+        code, _, posted, stored = _run_main(monkeypatch, tmp_path, None, events=[("_http", soon)])
+        assert code == 0
+        messages.extend(posted)
+
+    assert len(messages) == 1
+    assert stored == {"_http": int(soon.timestamp())}
+
+
+@pytest.mark.parametrize("max_events, expected", [(None, ["a", "b", "c"]), ("2", ["a", "b"])])
+def test_main_notifies_earliest_events_in_start_order(monkeypatch, tmp_path, max_events, expected):
+    now = datetime.now(timezone.utc)
+    events = [
+        ("b", now + timedelta(minutes=20)),
+        ("c", now + timedelta(minutes=25)),
+        ("a", now + timedelta(minutes=10)),
+    ]
+    if max_events:
+        monkeypatch.setenv("MAX_EVENTS", max_events)
+
+    code, _, posted, stored = _run_main(monkeypatch, tmp_path, {}, events=events)
+
+    assert code == 0
+    assert len(posted) == 1
+    summaries = [line[len("- **"):-len("**")] for line in posted[0].splitlines() if line.startswith("- **")]
+    assert summaries == expected
+    assert sorted(stored) == expected
+
+
+def test_main_keeps_calendar_cache_when_webhook_fails(monkeypatch, tmp_path):
+    soon = datetime.now(timezone.utc) + timedelta(minutes=5)
+
+    def failing_post(url: str, json, timeout: int) -> DummyResponse:  # type: ignore[unused-arg]
+        raise RuntimeError("webhook down")
+
+    code, _, _, stored = _run_main(
+        monkeypatch, tmp_path, {}, events=[("soon", soon)], etag='"v2"', post=failing_post
+    )
+
+    assert code == 1
+    assert stored == {}
+    assert notifier.load_http_cache(str(tmp_path / "calendar.ics")) == {"etag": '"v1"'}